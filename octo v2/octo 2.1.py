@@ -1,6 +1,12 @@
 import pygame
 import math
 import random
+import sys
+import time
+import io
+import multiprocessing
+import threading
+import numpy as np
 
 SIZE = (800,600) #pixel size of window
 
@@ -14,58 +20,309 @@ QUADRAG = .008
 
 CLOSEMULT = .001
 MAXCLOSE = 10
+REPULSION = 'verlet' #'verlet', 'grid' or 'brute', how close node pairs are found
+SKIN = 4 #extra distance kept in the verlet pair list, rebuilt after a node moves half of it
+
+INTEGRATOR = 'legacy' #'legacy', 'euler', 'verlet', 'implicit' or 'xpbd', see INTEGRATORS
+CGITERATIONS = 40 #most conjugate gradient iterations per implicit step
+CGTOLERANCE = 1e-6 #relative residual the implicit solve stops at
+XPBDGROUPS = { 0:(10,1), pygame.K_j:(10,1), pygame.K_l:(10,1) } #link control: iterations, compliance scale
+#a link's compliance is its group's scale over its stiffness, so 1 is the same material as the springs
+FRAMERATE = 30 #simulated frames per second, one frame of physics is dt=1
+PHYSICSRATE = 120 #physics steps per second
+MAXSTEPS = 8 #most physics steps per drawn frame, past this the simulation slows instead
+THREADED = True #whether physics runs on its own thread while the main thread draws
+DRAWRATE = 60 #most drawn frames per second when physics is threaded
 
 DEFAULTPATH = 'tnoco.txt'
+TERRAINPATH = None #height profile to load as the ground, a flat floor if None
+ROCKSPATH = None #polygons to load as rocks, none if None
+FLOORHEIGHT = -150
+FRICTION = .3 #speed lost sliding along terrain per unit of speed stopped going into it
+BOUNCE = 0 #fraction of the speed going into terrain it's sent back out with
+SWEEP = True #whether nodes are stopped where their path hit scenery, rather than only where they ended up
 
 WHICHDRAW = (True,False,False) #whether to draw triangles, links, points
+NODERADIUS = 3 #pixels
+LODSIZE = 40 #pixels, jellies smaller than this on screen are drawn as a coarse copy, 0 never does
+LODCELLS = 6 #the coarse copy merges nodes on a grid this many cells across the jelly
+
+LINKK = 0.069 #stiffness new links are given
+LINKDAMPING = 0 #damping new links are given, slowing their ends moving apart or together
+NODEMASS = 1 #mass nodes are given when the jelly file doesn't say
+
+JELLYCONTACT = 'links' #'nodes', 'links' or None, how different jellies push each other apart
+JELLYSTIFFNESS = 1 #fraction of how far nodes of different jellies are inside MAXCLOSE they're moved back out
+SELFCONTACT = 'nodes' #'nodes' or 'links', whether a jelly's nodes are also pushed off its own links
+SELFSTIFFNESS = 1 #push per mm a node is inside MAXCLOSE of one of its own links it didn't start near
+
+SLEEP = True #whether still groups of linked nodes stop being simulated
+SLEEPENERGY = .001 #kinetic energy per node a group must stay under to fall asleep
+SLEEPSTEPS = 60 #physics steps a group must stay still for before it sleeps
 
 '''
 Changed from 2.0: Removed converting functionality, added some controls
 '''
 
+class Config():
+    #physics and drawing settings for one world, starting from the module constants
+    #worlds with their own config can run side by side with different physics
+
+    def __init__(self, **changes):
+
+        self.size = SIZE
+        self.campos = CAMPOS
+        self.zoom = ZOOM
+        self.whichDraw = WHICHDRAW
+
+        self.air = AIR
+        self.linDrag = LINDRAG
+        self.quadDrag = QUADRAG
+        self.closeMult = CLOSEMULT
+        self.maxClose = MAXCLOSE
+        self.linkK = LINKK
+        self.linkDamping = LINKDAMPING
+        self.lodSize = LODSIZE
+        self.lodCells = LODCELLS
+        self.jellyContact = JELLYCONTACT
+        self.jellyStiffness = JELLYSTIFFNESS
+        self.selfContact = SELFCONTACT
+        self.selfStiffness = SELFSTIFFNESS
+        self.sweep = SWEEP
+
+        self.repulsion = REPULSION
+        self.skin = SKIN
+        self.integrator = INTEGRATOR
+        self.cgIterations = CGITERATIONS
+        self.cgTolerance = CGTOLERANCE
+        self.xpbdGroups = dict(XPBDGROUPS)
+        self.physicsRate = PHYSICSRATE
+        self.maxSteps = MAXSTEPS
+        self.sleep = SLEEP
+        self.sleepEnergy = SLEEPENERGY
+        self.sleepSteps = SLEEPSTEPS
+
+        self.change(**changes)
+
+    def change(self, **changes):
+        for name,value in changes.items():
+            assert hasattr(self,name), name
+            setattr(self,name,value)
+        return self
+
+
+defaultConfig = Config()
+
+
 class World():
 
-    def __init__(self,filename):
+    def __init__(self,filename,config=None,terrain=TERRAINPATH,rocks=ROCKSPATH):
+
+        self.config = config = config if config else Config()
         
-        self.size = SIZE
+        self.size = config.size
 
-        self.cont = [ Jelly(filename) ]
-        self.scenery = [ Floor(-150) ]
+        self.cont = [ Jelly(filename,config) ]
+        self.scenery = [ loadTerrain(terrain,config) if terrain else Floor(FLOORHEIGHT,config) ]
+        if rocks:
+            self.scenery.append( loadRocks(rocks,config) )
 
-        self.zoom = ZOOM
-        self.campos = CAMPOS
+        self.zoom = config.zoom
+        self.campos = config.campos
 
-        pygame.init()
-        self.screen = pygame.display.set_mode( self.size )
+        self.dt = FRAMERATE/config.physicsRate
+        self.accumulator = 0
+
+        self.sweepOrder = []
+        self.stats = {'jellyPairs':0, 'jellyContacts':0}
+        self.drawStats = {'drawn':0, 'culled':0, 'coarse':0}
+
+        #held while stepping or editing, so a physics thread and the main thread take turns
+        self.lock = threading.Lock()
+        #node positions published for drawing, front then back, and the one being drawn
+        self.snapshots = [None, None]
+        self.drawing = None
+        self.snapshotLock = threading.Lock()
+
+        self.window = None
+
+
+    def attachWindow(self):
+        self.window = Window(self.size)
+        return self.window
 
 
     def draw(self):
+        if self.window:
+            self.drawStats = {'drawn':0, 'culled':0, 'coarse':0}
+            positions = self.snapshot()
+            if positions is not None and [len(p) for p in positions] != [len(obj.pos) for obj in self.cont]:
+                positions = None
+            self.window.draw(self, positions)
+            with self.snapshotLock:
+                self.drawing = None
+
+
+    def publish(self):
+        #copies every jelly's node positions into the back snapshot and swaps it to the front,
+        #never writing into the one being drawn
+        with self.snapshotLock:
+            back = self.snapshots[1]
+            if back is self.drawing:
+                back = None
+        if back is None or [len(p) for p in back] != [len(obj.pos) for obj in self.cont]:
+            back = [ obj.pos.copy() for obj in self.cont ]
+        else:
+            for p,obj in zip(back, self.cont):
+                p[:] = obj.pos
+        with self.snapshotLock:
+            self.snapshots = [ back, self.snapshots[0] ]
 
-        self.screen.fill( (0,40,80) )
 
-        for sce in self.scenery:
-            sce.draw(self.screen, self)
+    def snapshot(self):
+        #newest published positions, kept from being written to until drawing is done
+        with self.snapshotLock:
+            self.drawing = self.snapshots[0]
+            return self.drawing
 
-        for obj in self.cont:
-            obj.draw(self.screen, self)
 
-        pygame.display.update()
-            
+    def run(self, frames):
+        for _ in range(frames):
+            self.frame()
+
+
+    def advance(self, seconds):
+        #runs however many fixed physics steps fit in the time passed, returns how many
 
-    def frame(self):
+        self.accumulator += seconds*FRAMERATE
+        steps = 0
+        while self.accumulator >= self.dt and steps < self.config.maxSteps:
+            self.frame(self.dt)
+            self.accumulator -= self.dt
+            steps += 1
 
+        if steps == self.config.maxSteps:
+            self.accumulator = min( self.accumulator, self.dt )
+        return steps
+            
+
+    def frame(self, dt=1):
         for obj in self.cont:
-            obj.update()
+            obj.wakeIfDisturbed()
+
+        INTEGRATORS[self.config.integrator](self, dt)
 
         for obj in self.cont:
-            obj.move()
+            obj.updateSleep()
+
 
+    def collide(self):
+        #jellies are pushed apart first so scenery has the last word
+        self.collideJellies()
         for obj in self.cont:
             for s in self.scenery:
                 s.interact(obj)
-
-        for obj in self.cont:
-            obj.move()
+            obj.sweptFrom = obj.pos.copy()
+
+
+    def collideJellies(self):
+        #sweep and prune over jelly bounding boxes, only overlapping jellies are tested
+        mode = self.config.jellyContact
+        if not mode or len(self.cont) < 2:
+            return
+
+        reach = self.config.maxClose
+        boxes = [ obj.bounds(reach/2) for obj in self.cont ]
+        if len(self.sweepOrder) != len(self.cont):
+            self.sweepOrder = list(range(len(self.cont)))
+        self.sweepOrder.sort( key=lambda n: boxes[n][0] )
+
+        active = []
+        for a in self.sweepOrder:
+            left, right, bottom, top = boxes[a]
+            active = [ b for b in active if boxes[b][1] >= left ]
+            for b in active:
+                if boxes[b][2] <= top and bottom <= boxes[b][3]:
+                    if not (self.cont[a].asleep and self.cont[b].asleep):
+                        self.touchJellies( self.cont[a], self.cont[b], boxes[a], boxes[b], mode )
+            active.append(a)
+
+
+    def touchJellies(self, one, two, boxOne, boxTwo, mode):
+        #pushes two jellies apart, looking only where their boxes overlap
+        self.stats['jellyPairs'] += 1
+        reach = self.config.maxClose
+        box = ( max(boxOne[0],boxTwo[0]), min(boxOne[1],boxTwo[1]),
+                max(boxOne[2],boxTwo[2]), min(boxOne[3],boxTwo[3]) )
+        nearOne, nearTwo = one.nodesIn(box, reach/2), two.nodesIn(box, reach/2)
+
+        hitOne, hitTwo = self.nodesOffNodes( one, nearOne, two, nearTwo )
+        if mode == 'links':
+            linksOne, linksTwo = one.linksIn(box, reach/2), two.linksIn(box, reach/2)
+            offOne, offTwo = self.nodesOffLinks( one, nearOne, two, linksTwo )
+            backTwo, backOne = self.nodesOffLinks( two, nearTwo, one, linksOne )
+            hitOne = np.concatenate( (hitOne,offOne,backOne) )
+            hitTwo = np.concatenate( (hitTwo,offTwo,backTwo) )
+
+        self.stats['jellyContacts'] += len(hitOne)
+        one.wake( one.islands()[hitOne] )
+        two.wake( two.islands()[hitTwo] )
+
+
+    def nodesOffNodes(self, one, nearOne, two, nearTwo):
+        #moves nodes of two jellies closer than reach apart, returns the nodes of each touching
+        config = self.config
+        reach = config.maxClose
+        count = len(nearOne)
+        pos = np.concatenate( (one.pos[nearOne], two.pos[nearTwo]) )
+
+        i,j,_ = gridPairs( pos, reach )
+        i,j = np.where(i<count,i,j), np.where(i<count,j,i)
+        cross = (i<count) & (j>=count)
+        i,j = i[cross], j[cross]
+        dis = pos[i] - pos[j]
+        d = np.abs(dis)
+        close = d<reach
+        i,j,dis,d = i[close], j[close]-count, dis[close], d[close]
+
+        a, b = nearOne[i], nearTwo[j]
+        shift, impulse = contactPushes( dis, one.vel[a]-two.vel[b], 1/one.nodeMass[a] + 1/two.nodeMass[b],
+                                        reach, config.jellyStiffness )
+        share = 1 / one.nodeMass / contactCounts( a, len(one.pos) )
+        one.pos += scatterAdd( a, shift, len(one.pos) ) * share
+        one.vel += scatterAdd( a, impulse, len(one.pos) ) * share
+        share = 1 / two.nodeMass / contactCounts( b, len(two.pos) )
+        two.pos -= scatterAdd( b, shift, len(two.pos) ) * share
+        two.vel -= scatterAdd( b, impulse, len(two.pos) ) * share
+        return a, b
+
+
+    def nodesOffLinks(self, one, nearOne, two, linksTwo):
+        #moves nodes of one jelly off the links of another, the link's ends taking
+        #the reaction split by how far along the contact is, returns the nodes touching
+        #closest to an end is left to nodesOffNodes, which would otherwise push twice
+        config = self.config
+        reach = config.maxClose
+        pos = one.pos[nearOne]
+        start, end = two.linkStart[linksTwo], two.linkEnd[linksTwo]
+
+        i,l = segmentGridPairs( pos, two.pos[start], two.pos[end], reach )
+        dis, t = segmentOffsets( pos[i], two.pos[start[l]], two.pos[end[l]] )
+        close = (np.abs(dis) < reach) & (t > 0) & (t < 1)
+        i, l, t, dis = i[close], l[close], t[close], dis[close]
+
+        a, s, e = nearOne[i], start[l], end[l]
+        linkVel = (1-t)*two.vel[s] + t*two.vel[e]
+        invMass = 1/one.nodeMass[a] + (1-t)**2/two.nodeMass[s] + t**2/two.nodeMass[e]
+        shift, impulse = contactPushes( dis, one.vel[a]-linkVel, invMass, reach, config.jellyStiffness )
+        share = 1 / one.nodeMass / contactCounts( a, len(one.pos) )
+        one.pos += scatterAdd( a, shift, len(one.pos) ) * share
+        one.vel += scatterAdd( a, impulse, len(one.pos) ) * share
+        ends = np.concatenate((s,e))
+        share = 1 / two.nodeMass / contactCounts( ends, len(two.pos) )
+        two.pos -= scatterAdd( ends, np.concatenate(((1-t)*shift,t*shift)), len(two.pos) ) * share
+        two.vel -= scatterAdd( ends, np.concatenate(((1-t)*impulse,t*impulse)), len(two.pos) ) * share
+        return a, ends
 
 
     def toScreen(self, pos):
@@ -75,6 +332,27 @@ class World():
         return int(sx),int(sy)
 
 
+    def toScreenArray(self, pos):
+        #toScreen for an array of positions at once, a row of pixel x and y for each
+        relPos = pos - self.campos
+        sx, sy = self.size[0]/2 + relPos.real/self.zoom, self.size[1]/2 - relPos.imag/self.zoom
+        return np.stack( (sx,sy), axis=-1 ).astype(int)
+
+
+    def onScreen(self, pixels, pad=0):
+        #whether the box around each row of pixel points overlaps the window
+        low, high = pixels.min(axis=-2), pixels.max(axis=-2)
+        return ( (low[...,0] <= self.size[0]+pad) & (high[...,0] >= -pad) &
+                 (low[...,1] <= self.size[1]+pad) & (high[...,1] >= -pad) )
+
+
+    def view(self, pad=0):
+        #left, right, bottom and top of what the window shows
+        low = self.fromScreen(-pad, self.size[1]+pad)
+        high = self.fromScreen(self.size[0]+pad, -pad)
+        return ( low.real, high.real, low.imag, high.imag )
+
+
     def fromScreen(self, sx,sy):
         relX = sx - self.size[0]/2
         relY = self.size[1]/2 - sy
@@ -84,22 +362,425 @@ class World():
         return relPos
 
 
-class Floor():
+class PhysicsThread(threading.Thread):
+    #steps a world in real time away from the main thread, which pygame needs for
+    #events and the display, publishing positions after every batch of steps
 
-    def __init__(self, height):
+    def __init__(self, world):
+        threading.Thread.__init__(self, daemon=True)
+        self.world = world
+        self.running = True
+        self.error = None
 
-        self.height = height
+    def run(self):
+        world = self.world
+        last = time.perf_counter()
+        try:
+            while self.running:
+                now = time.perf_counter()
+                with world.lock:
+                    steps = world.advance(now-last)
+                    if steps:
+                        world.publish()
+                last = now
+                #wait about one physics step before looking again
+                time.sleep( max(0, 1/world.config.physicsRate - (time.perf_counter()-now)) )
+        except BaseException as error:
+            #kept for the main thread to raise, a thread dying alone just freezes the picture
+            self.error = error
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+        assert self.is_alive() or not self.running, 'physics thread stopped'
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.check()
+
+
+def legacyStep(world, dt):
+    #the original frame, positions move twice per velocity update
+
+    for obj in world.cont:
+        obj.update(dt)
+    for obj in world.cont:
+        obj.move(dt)
+    world.collide()
+    for obj in world.cont:
+        obj.move(dt)
+
+
+def eulerStep(world, dt):
+    #semi-implicit euler, velocities first then positions with the new velocities
+
+    for obj in world.cont:
+        obj.update(dt)
+    for obj in world.cont:
+        obj.move(dt)
+    world.collide()
+
+
+def verletStep(world, dt):
+    #position verlet, forces taken half way through the step
+
+    for obj in world.cont:
+        obj.move(dt/2)
+    for obj in world.cont:
+        obj.update(dt)
+    for obj in world.cont:
+        obj.move(dt/2)
+    world.collide()
+
+
+def implicitStep(world, dt):
+    #backward euler for links, lets much stiffer links take large steps
+
+    for obj in world.cont:
+        obj.implicitUpdate(dt)
+    for obj in world.cont:
+        obj.move(dt)
+    world.collide()
+
+
+def xpbdStep(world, dt):
+    #position based, links are distance constraints and scenery pushes nodes back out
+
+    for obj in world.cont:
+        obj.predict(dt)
+
+    iterations = max( [obj.linkIterations.max(initial=0) for obj in world.cont] )
+    for i in range(iterations):
+        for obj in world.cont:
+            obj.solveLinks(i, dt)
+        world.collide()
+    if not iterations:
+        world.collide()
+
+    for obj in world.cont:
+        obj.settle(dt)
+
+
+INTEGRATORS = { 'legacy':legacyStep, 'euler':eulerStep, 'verlet':verletStep,
+                'implicit':implicitStep, 'xpbd':xpbdStep }
+
+
+class Window():
+    #pygame display, only needed when a world is being watched
+
+    def __init__(self, size):
+
+        pygame.init()
+        self.screen = pygame.display.set_mode( size )
+
+        #scenery doesn't move, so it's drawn once and kept until the camera moves
+        self.background = pygame.Surface( size )
+        self.backgroundView = None
+        self.dirty = []
+
+
+    def sceneryChanged(self):
+        self.backgroundView = None
+
+
+    def draw(self, world, positions=None):
+        #positions is a snapshot of every jelly's node positions, the live ones if None
+
+        view = ( world.campos, world.zoom, [id(sce) for sce in world.scenery] )
+        if view != self.backgroundView:
+            self.background.fill( (0,40,80) )
+            for sce in world.scenery:
+                sce.draw(self.background, world)
+            self.backgroundView = view
+            self.screen.blit( self.background, (0,0) )
+            self.dirty = [ self.screen.get_rect() ]
+        else:
+            #only where jellies were last frame needs the background back
+            for rect in self.dirty:
+                self.screen.blit( self.background, rect, rect )
+
+        drawn = []
+        for obj,pos in zip( world.cont, positions or [None]*len(world.cont) ):
+            obj.draw(self.screen, world, pos)
+            drawn.append( self.coverRect(obj, world, pos) )
+
+        pygame.display.update( self.dirty + drawn )
+        self.dirty = drawn
+
+
+    def coverRect(self, obj, world, pos=None):
+        #screen rectangle everything drawn for a jelly fits in, clipped to the window
+        left, right, bottom, top = obj.bounds(pos=pos)
+        if left > right:
+            return pygame.Rect(0,0,0,0)
+        x0, y0 = world.toScreen( left + top*1j )
+        x1, y1 = world.toScreen( right + bottom*1j )
+        pad = NODERADIUS+1
+        rect = pygame.Rect( x0-pad, y0-pad, x1-x0+2*pad+1, y1-y0+2*pad+1 )
+        return rect.clip( self.screen.get_rect() )
+
+
+class Terrain():
+    #ground following a height profile, heights between the sampled xs are interpolated
+    #and it carries on flat past either end
+
+    def __init__(self, xs, heights, friction=FRICTION, bounce=BOUNCE, config=None):
+
+        order = np.argsort(xs)
+        self.xs = np.asarray(xs, dtype=float)[order]
+        self.heights = np.asarray(heights, dtype=float)[order]
+        self.friction = friction
+        self.bounce = bounce
+        self.config = config if config else defaultConfig
+
+        #normals of each piece, including the flat parts off either end
+        slopes = np.diff(self.heights) / np.maximum( np.diff(self.xs), 1e-12 )
+        normals = (1j - slopes) / np.sqrt(1 + slopes**2)
+        self.normals = np.concatenate( ([1j], normals, [1j]) )
+
+
+    def heightAt(self, x):
+        return np.interp( x, self.xs, self.heights )
+
+
+    def normalAt(self, x):
+        return self.normals[ np.searchsorted(self.xs, x, 'right') ]
+
+
+    def push(self, pos, vel, contacts=None):
+        #moves points under the surface back out along its normal, stops them going into it
+        #and slows them sliding along it by friction, returns which were touching
+        #if given contacts, the points touched are added to it with normals and velocities
+        height = self.heightAt(pos.real)
+        below = pos.imag < height
+        if not below.any():
+            return below
+
+        p = pos[below]
+        normal = self.normalAt(p.real)
+        pos[below] = p + (height[below] - p.imag) * normal.imag * normal
+        if contacts is not None:
+            contacts.append( (self, below, normal, vel[below]) )
+        vel[below] = contactVelocity( vel[below], normal, self.friction, self.bounce )
+        return below
+
+
+    def sweep(self, start, pos, vel, contacts=None):
+        #points whose path from start dipped under the surface are put back where it first did,
+        #then carried on along the surface for the rest of the step, returns which hit
+        #under the surface the height left along a path is linear between the sampled xs
+        start, end = start.ravel(), pos.ravel()
+        x0, x1 = start.real, end.real
+        gap0 = start.imag - self.heightAt(x0)
+        gap1 = end.imag - self.heightAt(x1)
+        lo = np.searchsorted( self.xs, np.minimum(x0,x1), 'right' )
+        hi = np.searchsorted( self.xs, np.maximum(x0,x1), 'left' )
+        hit = np.zeros( len(end), dtype=bool )
+
+        #only points that started above and either ended below or passed over a sample
+        moving = np.flatnonzero( (gap0 >= 0) & ((gap1 < 0) | (hi > lo)) )
+        if not len(moving):
+            return hit.reshape(pos.shape)
+
+        #a path straight down onto a sample has lo one past hi, it crosses no samples
+        counts = np.maximum( hi[moving] - lo[moving], 0 )
+        point = np.repeat( moving, counts )
+        sample = np.repeat( lo[moving], counts ) + np.arange(counts.sum()) - np.repeat( np.cumsum(counts)-counts, counts )
+        dx, dy = x1[point]-x0[point], end.imag[point]-start.imag[point]
+        t = (self.xs[sample] - x0[point]) / dx
+        gap = start.imag[point] + t*dy - self.heights[sample]
+
+        point = np.concatenate( (moving, moving, point) )
+        t = np.concatenate( (np.zeros(len(moving)), np.ones(len(moving)), t) )
+        gap = np.concatenate( (gap0[moving], gap1[moving], gap) )
+        order = np.lexsort( (t, point) )
+        point, t, gap = point[order], t[order], gap[order]
+
+        #first time along each path the gap goes negative, the one before it is still above
+        under = np.flatnonzero( gap < 0 )
+        first = under[ np.r_[True, point[under][1:] != point[under][:-1]] ] if len(under) else under
+        before = first-1
+        point = point[first]
+        toi = t[before] + (t[first]-t[before]) * gap[before] / (gap[before]-gap[first])
+
+        path = end[point] - start[point]
+        at = start[point] + toi*path
+        normal = self.normalAt( start[point].real + (t[before]+t[first])/2 * path.real )
+        at = at.real + self.heightAt(at.real)*1j
+        flat = vel.ravel()
+        end[point] = at + contactVelocity( (1-toi)*path, normal, 0, self.bounce )
+        if contacts is not None:
+            contacts.append( (self, point, normal, flat[point]) )
+        flat[point] = contactVelocity( flat[point], normal, self.friction, self.bounce )
+        hit[point] = True
+        return hit.reshape(pos.shape)
+
+
+    def interact(self, jelly):
+
+        if jelly.asleep:
+            return
+        if self.config.sweep and jelly.sweptFrom is not None:
+            self.sweep( jelly.sweptFrom, jelly.pos, jelly.vel, jelly.contacts )
+        self.push( jelly.pos, jelly.vel, jelly.contacts )
+
+
+    def draw(self, surf, world):
+        left, right = world.fromScreen(0,0).real, world.fromScreen(world.size[0],0).real
+        inside = (self.xs > left) & (self.xs < right)
+        xs = np.concatenate( ([left], self.xs[inside], [right]) )
+        points = [ world.toScreen(x + h*1j) for x,h in zip(xs, self.heightAt(xs)) ]
+        points += [ (world.size[0],world.size[1]), (0,world.size[1]) ]
+        pygame.draw.polygon( surf, (255,200,100), points )
+
+
+class Rocks():
+    #closed polygons nodes can't get inside, all their edges are kept in one segment tree
+    #so nodes only look at edges near them, a polygon inside another is a cave
+
+    def __init__(self, polygons, friction=FRICTION, bounce=BOUNCE, config=None):
+
+        self.polygons = [ np.asarray(p, dtype=complex) for p in polygons ]
+        self.friction = friction
+        self.bounce = bounce
+        self.config = config if config else defaultConfig
+
+        self.a = np.concatenate( [p for p in self.polygons] + [np.zeros(0,dtype=complex)] )
+        self.b = np.concatenate( [np.roll(p,-1) for p in self.polygons] + [np.zeros(0,dtype=complex)] )
+        self.owner = np.concatenate( [np.full(len(p),n) for n,p in enumerate(self.polygons)] + [np.zeros(0,dtype=int)] )
+        self.tree = SegmentTree( self.a, self.b )
+
+        #which way each edge's outward normal turns from it, by the polygon's winding,
+        #flipped for caves since their solid is on the outside
+        corners = np.array( [p[0] for p in self.polygons], dtype=complex )
+        cave = self.inside( corners, ignore=np.arange(len(self.polygons)) )
+        turns = []
+        for p,isCave in zip(self.polygons, cave):
+            anticlockwise = (p.conjugate()*np.roll(p,-1)).imag.sum() > 0
+            turns.append( np.full(len(p), -1j if anticlockwise != isCave else 1j) )
+        self.outward = np.concatenate( turns + [np.zeros(0,dtype=complex)] )
+
+
+    def inside(self, pos, ignore=None):
+        #odd number of edges crossed by a ray from each point towards +x,
+        #leaving out the edges of polygon ignore[i] for point i if given
+        x, y = pos.real, pos.imag
+        i,e = self.tree.overlapping( x, np.full(len(pos),np.inf), y, y )
+        if ignore is not None:
+            keep = self.owner[e] != ignore[i]
+            i, e = i[keep], e[keep]
+        a, b = self.a[e], self.b[e]
+        straddles = (a.imag > y[i]) != (b.imag > y[i])
+        i, a, b = i[straddles], a[straddles], b[straddles]
+        crossX = a.real + (y[i]-a.imag) * (b.real-a.real) / (b.imag-a.imag)
+        crossings = np.bincount( i[crossX > x[i]], minlength=len(pos) )
+        return crossings % 2 == 1
+
+
+    def closest(self, pos):
+        #closest point on any edge to each point, looking further out for points it missed
+        closest = np.zeros( len(pos), dtype=complex )
+        left = np.arange( len(pos) )
+        reach = self.config.maxClose
+        while len(left) and len(self.a):
+            i,e = self.tree.query( pos[left], reach )
+            a, b = self.a[e], self.b[e]
+            p = pos[left][i]
+            along = b - a
+            t = np.clip( (along.conjugate()*(p-a)).real / np.maximum(np.abs(along)**2, 1e-12), 0, 1 )
+            q = a + t*along
+            d = np.abs(p-q)
+
+            #nearest edge for each point, only trusted if it's within reach
+            order = np.lexsort( (d, i) )
+            first = np.ones( len(order), dtype=bool )
+            first[1:] = i[order][1:] != i[order][:-1]
+            best = order[first]
+            found = d[best] <= reach
+            closest[ left[i[best][found]] ] = q[best][found]
+
+            done = np.zeros( len(left), dtype=bool )
+            done[ i[best][found] ] = True
+            left = left[~done]
+            reach *= 2
+        return closest
+
+
+    def push(self, pos, vel, contacts=None):
+        #moves points inside a rock out to its nearest edge, returns which were inside
+        #if given contacts, the points touched are added to it as in Terrain.push
+        inside = self.inside(pos)
+        if not inside.any():
+            return inside
+
+        p = pos[inside]
+        q = self.closest(p)
+        out = q - p
+        normal = out / np.maximum( np.abs(out), 1e-12 )
+        pos[inside] = q
+        if contacts is not None:
+            contacts.append( (self, inside, normal, vel[inside]) )
+        vel[inside] = contactVelocity( vel[inside], normal, self.friction, self.bounce )
+        return inside
+
+
+    def sweep(self, start, pos, vel, contacts=None):
+        #points whose path from start went into a rock through an edge are put back where it
+        #first did, then carried on along the edge for the rest of the step, returns which hit
+        path = pos - start
+        i,e = self.tree.overlapping( np.minimum(start.real,pos.real), np.maximum(start.real,pos.real),
+                                     np.minimum(start.imag,pos.imag), np.maximum(start.imag,pos.imag) )
+        a, edge, d = self.a[e], self.b[e]-self.a[e], path[i]
+        normal = self.outward[e]*edge / np.maximum( np.abs(edge), 1e-12 )
+        cross = (d.conjugate()*edge).imag
+        offset = a - start[i]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (offset.conjugate()*edge).imag / cross
+            s = (offset.conjugate()*d).imag / cross
+        #only paths heading into the solid count, so points resting on an edge
+        #are caught right at the start while ones leaving it go free
+        entering = (normal.conjugate()*d).real < 0
+        crossing = entering & (t >= 0) & (t <= 1) & (s >= 0) & (s <= 1)
+        i, t, d, normal = i[crossing], t[crossing], d[crossing], normal[crossing]
+        hit = np.zeros( len(pos), dtype=bool )
+        if not len(i):
+            return hit
+
+        order = np.lexsort( (t, i) )
+        first = order[ np.r_[True, i[order][1:] != i[order][:-1]] ]
+        i, t, d, normal = i[first], t[first], d[first], normal[first]
+
+        pos[i] = start[i] + t*d + contactVelocity( (1-t)*d, normal, 0, self.bounce )
+        if contacts is not None:
+            contacts.append( (self, i, normal, vel[i]) )
+        vel[i] = contactVelocity( vel[i], normal, self.friction, self.bounce )
+        hit[i] = True
+        return hit
 
 
     def interact(self, jelly):
 
-        for node in jelly.nodes:
-            nodey = node.pos.imag
-            if nodey < self.height:
-                force = (self.height - nodey)*.1
-                force = force if force>-1 else -1
-                node.pos = node.pos.real + self.height*1j
-                node.vel = node.vel.real 
+        if jelly.asleep:
+            return
+        if self.config.sweep and jelly.sweptFrom is not None:
+            self.sweep( jelly.sweptFrom, jelly.pos, jelly.vel, jelly.contacts )
+        self.push( jelly.pos, jelly.vel, jelly.contacts )
+
+
+    def draw(self, surf, world):
+        for polygon in self.polygons:
+            pygame.draw.polygon( surf, (150,130,110), [world.toScreen(p) for p in polygon] )
+
+
+class Floor(Terrain):
+    #flat terrain with no friction
+
+    def __init__(self, height, config=None):
+
+        Terrain.__init__( self, [0], [height], 0, 0, config )
+        self.height = height
+
 
     def draw(self, surf, world):
         screenH = world.toScreen(self.height*1j)[1]
@@ -108,101 +789,735 @@ class Floor():
 
 class Jelly():
 
-    def __init__(self,filename):
+    def __init__(self,filename,config=None):
+
+        self.config = config if config else defaultConfig
 
         self.nodes = [ Node(0,0) ]
         self.links = []
         self.tris = []
 
+        self.gridOrder = None
+        self.pairs = None
+        self.guess = None
+        self.colours = None
+        self.linkTree = None
+        self.sweptFrom = None
+        self.contacts = None
+        self.triCorners = None
+        self.coarseCache = None
+        self.islandOf = None
+        self.asleep = False
+        self.sleeping = None
+        self.stats = {'pairRebuilds':0, 'pairSteps':0, 'cgIterations':0, 'cgSolves':0}
+
         loadJelly( filename, self )
+        self.pack()
         self.controlLinks = { pygame.K_j:[l for l in self.links if l.control==106],
                               pygame.K_l:[l for l in self.links if l.control==pygame.K_l] }
 
 
-    def draw(self,surf,world):
+    def pack(self):
+        #copies node and link state into arrays, nodes and links then act as views into them
+
+        self.pos = np.array( [n.pos for n in self.nodes], dtype=complex )
+        self.vel = np.array( [n.vel for n in self.nodes], dtype=complex )
+        self.nodeMass = np.array( [n.mass for n in self.nodes], dtype=float )
+
+        self.linkLength  = np.array( [l.length  for l in self.links], dtype=float )
+        self.linkK       = np.array( [l.k       for l in self.links], dtype=float )
+        self.linkDamping = np.array( [l.damping for l in self.links], dtype=float )
+        self.linkExtMult = np.array( [l.extMult for l in self.links], dtype=float )
 
-        toDraw = [ [self.tris,self.links,self.nodes][i] for i in range(3) if WHICHDRAW[i] ]
-        #toDraw = (self.tris,)
+        for i,node in enumerate(self.nodes):
+            node.jelly, node.index = self, i
+        for i,link in enumerate(self.links):
+            link.jelly, link.index = self, i
+
+        self.linkStart = np.array( [l.start.index for l in self.links], dtype=int )
+        self.linkEnd   = np.array( [l.end.index   for l in self.links], dtype=int )
+        self.linkEnds  = np.concatenate( (self.linkStart,self.linkEnd) )
+        self.linkControls = np.array( [l.control for l in self.links], dtype=int )
+
+        xpbdGroups = self.config.xpbdGroups
+        groups = [ xpbdGroups.get(l.control, xpbdGroups[0]) for l in self.links ]
+        self.linkIterations = np.array( [g[0] for g in groups], dtype=int )
+        self.linkCompliance = np.array( [g[1] for g in groups], dtype=float )
+
+        self.pairs = None
+        self.guess = None
+        self.linkTree = None
+        self.sweptFrom = None
+        self.contacts = None
+        self.triCorners = None
+        self.coarseCache = None
+        self.islandOf = None
+        self.asleep = False
+        self.sleeping = None
+
+
+    def addNode(self, pos):
+        node = Node(pos)
+        self.nodes.append( node )
+        self.pack()
+        return node
+
+
+    def addLink(self, start, end):
+        link = start.connect(end)
+        self.links.append( link )
+        self.colours = None
+        self.pack()
+        return link
+
+
+    def setControl(self, link, control):
+        for group in self.controlLinks.values():
+            if link in group:
+                group.remove(link)
+        link.control = control
+        self.controlLinks[control].append(link)
+        self.pack()
+
+
+    def removeLink(self, link):
+        self.links.remove(link)
+        for group in self.controlLinks.values():
+            if link in group:
+                group.remove(link)
+        link.start.connected.remove(link.end)
+        link.end.connected.remove(link.start)
+        link.unbind()
+        self.colours = None
+        self.pack()
+
+
+    def linkColours(self):
+        #links split into batches that share no nodes, as (links, starts, ends)
+        #only worked out again after links are added or removed
+
+        if self.colours is None:
+            self.colours = []
+            for batch in colourLinks( self.linkStart, self.linkEnd, len(self.nodes) ):
+                self.colours.append( (batch, self.linkStart[batch], self.linkEnd[batch]) )
+        return self.colours
+
+
+    def energy(self):
+        #kinetic plus stored in the links
+        delta = self.pos[self.linkStart] - self.pos[self.linkEnd]
+        ext = np.abs(delta) - self.linkLength*self.linkExtMult
+        return .5*(self.nodeMass*np.abs(self.vel)**2).sum() + .5*(self.linkK*ext*ext).sum()
+
+
+    def bounds(self, pad=0, pos=None):
+        #left, right, bottom and top of the jelly's nodes, or of pos if given
+        pos = self.pos if pos is None else pos
+        if not len(pos):
+            return (np.inf, -np.inf, np.inf, -np.inf)
+        x, y = pos.real, pos.imag
+        return ( x.min()-pad, x.max()+pad, y.min()-pad, y.max()+pad )
+
+
+    def nodesIn(self, box, pad=0):
+        x, y = self.pos.real, self.pos.imag
+        return np.flatnonzero( (x >= box[0]-pad) & (x <= box[1]+pad) & (y >= box[2]-pad) & (y <= box[3]+pad) )
+
+
+    def linksIn(self, box, pad=0):
+        a, b = self.pos[self.linkStart], self.pos[self.linkEnd]
+        return np.flatnonzero( (np.maximum(a.real,b.real) >= box[0]-pad) & (np.minimum(a.real,b.real) <= box[1]+pad) &
+                               (np.maximum(a.imag,b.imag) >= box[2]-pad) & (np.minimum(a.imag,b.imag) <= box[3]+pad) )
+
+
+    def islands(self):
+        #which group of linked nodes each node is in, kept until the jelly is repacked
+        if self.islandOf is None:
+            self.islandOf = linkIslands( self.linkStart, self.linkEnd, len(self.nodes) )
+            count = self.islandOf.max(initial=-1)+1
+            self.islandStill = np.zeros( count, dtype=int )
+            self.islandAsleep = np.zeros( count, dtype=bool )
+        return self.islandOf
+
+
+    def updateSleep(self):
+        #islands that have stayed still for long enough stop moving until disturbed
+        if not self.config.sleep or self.asleep:
+            return
+        islandOf = self.islands()
+        count = len(self.islandAsleep)
+
+        energy = np.bincount( islandOf, .5*self.nodeMass*np.abs(self.vel)**2, count ) / np.bincount( islandOf, minlength=count )
+        still = energy < self.config.sleepEnergy
+        self.islandStill = np.where( still, self.islandStill+1, 0 )
+
+        falling = (self.islandStill >= self.config.sleepSteps) & ~self.islandAsleep
+        if falling.any():
+            self.islandAsleep |= falling
+            self.vel[ falling[islandOf] ] = 0
+            self.restPos = self.pos.copy()
+            self.restExtMult = self.linkExtMult.copy()
+            self.restAir = self.config.air
+            self.sleepChanged()
+
+
+    def wakeIfDisturbed(self):
+        #anything dragged or any control changed wakes its island, gravity changing wakes them all
+        if self.sleeping is None:
+            return
+        if self.config.air != self.restAir:
+            self.restAir = self.config.air
+            self.wake( np.arange(len(self.islandAsleep)) )
+            return
+        moved = self.sleeping & (self.pos != self.restPos)
+        changed = self.linkExtMult != self.restExtMult
+        self.wake( np.concatenate(( self.islandOf[moved], self.islandOf[self.linkStart[changed]] )) )
+
+
+    def wake(self, islands):
+        if len(islands) and self.islandAsleep[islands].any():
+            self.islandAsleep[islands] = False
+            self.islandStill[islands] = 0
+            self.sleepChanged()
+
+
+    def sleepChanged(self):
+        self.asleep = bool( self.islandAsleep.all() ) and len(self.islandAsleep) > 0
+        self.sleeping = self.islandAsleep[self.islandOf] if self.islandAsleep.any() else None
+
+
+    def diagnostics(self):
+        colours = self.linkColours()
+        self.islands()
+        return dict( self.stats, nodes=len(self.nodes), links=len(self.links),
+                     linkColours=len(colours), colourSizes=[len(c[0]) for c in colours],
+                     islands=len(self.islandAsleep), islandsAsleep=int(self.islandAsleep.sum()) )
+
+
+    def draw(self,surf,world,pos=None):
+        #pos is a snapshot of the node positions to draw instead of the live ones
+
+        pos = self.pos if pos is None else pos
+        toDraw = [ i for i in range(3) if world.config.whichDraw[i] ]
+        #toDraw = (0,)
+        total = sum( len([self.tris,self.links,self.nodes][i]) for i in toDraw )
+
+        #nothing to draw if the whole jelly is off screen
+        left, right, bottom, top = self.bounds(pos=pos)
+        viewLeft, viewRight, viewBottom, viewTop = world.view(NODERADIUS)
+        if left > viewRight or right < viewLeft or bottom > viewTop or top < viewBottom:
+            world.drawStats['culled'] += total
+            return
+
+        #small on screen, just a coarse copy
+        lodSize = world.config.lodSize * world.zoom
+        if 0 in toDraw and self.tris and max(right-left, top-bottom) < lodSize:
+            self.drawCoarse(surf, world, pos)
+            world.drawStats['coarse'] += 1
+            return
+
+        #every node is taken to the screen once, things look their nodes up by index
+        pixels = world.toScreenArray(pos)
+        screen = pixels.tolist()
+        if self.triCorners is None or len(self.triCorners) != len(self.tris):
+            self.triCorners = np.array( [[p.index for p in t.points] for t in self.tris], dtype=int ).reshape(-1,3)
+        corners = [ self.triCorners, np.stack((self.linkStart,self.linkEnd),axis=1), np.arange(len(self.nodes))[:,None] ]
+
+        drawn = 0
+        for i in toDraw:
+            thingList = [self.tris,self.links,self.nodes][i]
+            onScreen = np.flatnonzero( world.onScreen( pixels[corners[i]], NODERADIUS ) )
+            for k in onScreen:
+                thingList[k].draw(surf,world,screen)
+            drawn += len(onScreen)
+        world.drawStats['drawn'] += drawn
+        world.drawStats['culled'] += total - drawn
+
+
+    def drawCoarse(self, surf, world, pos):
+        coarse = self.coarse(pos)
+        centres = scatterAdd( coarse['cellOf'], pos, len(coarse['size']) ) / coarse['size']
+        screen = world.toScreenArray(centres).tolist()
+        for (a,b),colour in zip(coarse['links'].tolist(), coarse['linkColours']):
+            pygame.draw.line( surf, colour, screen[a], screen[b] )
+        for (a,b,c),colour in zip(coarse['tris'].tolist(), coarse['triColours']):
+            pygame.draw.polygon( surf, colour, (screen[a],screen[b],screen[c]) )
+        world.drawStats['drawn'] += len(coarse['tris']) + len(coarse['links'])
+
+
+    def coarse(self, pos):
+        #nodes merged on a grid over where they are now, drawn at the middle of each cell's nodes
+        #triangles between three cells are kept, links between two are drawn as lines so
+        #thin parts still show, kept until the jelly is edited
+        if self.coarseCache is not None and self.coarseCache['triCount'] == len(self.tris):
+            return self.coarseCache
+
+        left, right, bottom, top = self.bounds(pos=pos)
+        cellSize = max( right-left, top-bottom, 1e-9 ) / self.config.lodCells
+        cells = np.floor( (pos.real-left)/cellSize ) + 1j*np.floor( (pos.imag-bottom)/cellSize )
+        _, cellOf = np.unique( cells, return_inverse=True )
+        cellOf = cellOf.ravel()
+        count = cellOf.max(initial=-1) + 1
+
+        corners = cellOf[ np.array( [[p.index for p in t.points] for t in self.tris], dtype=int ).reshape(-1,3) ]
+        colours = np.array( [t.colour for t in self.tris], dtype=float ).reshape(-1,3)
+        whole = (corners[:,0]!=corners[:,1]) & (corners[:,1]!=corners[:,2]) & (corners[:,2]!=corners[:,0])
+        tris, triOf = np.unique( np.sort(corners[whole],axis=1), axis=0, return_inverse=True )
+        triOf = triOf.ravel()
+        triColours = np.stack( [np.bincount(triOf, colours[whole,c], len(tris)) for c in range(3)], axis=1 )
+        triColours /= np.maximum( np.bincount(triOf, minlength=len(tris)), 1 )[:,None]
+
+        #every cell takes the colour of the triangles touching it, for the lines
+        touching = np.repeat( colours, 3, axis=0 )
+        cellColours = np.stack( [np.bincount(corners.ravel(), touching[:,c], count) for c in range(3)], axis=1 )
+        cellColours /= np.maximum( np.bincount(corners.ravel(), minlength=count), 1 )[:,None]
+
+        ends = cellOf[ np.stack((self.linkStart,self.linkEnd),axis=1) ]
+        links = np.unique( np.sort(ends[ends[:,0]!=ends[:,1]],axis=1).reshape(-1,2), axis=0 )
+
+        linkColours = (cellColours[links[:,0]] + cellColours[links[:,1]]) / 2
+        self.coarseCache = { 'triCount':len(self.tris), 'cellOf':cellOf, 'size':np.bincount(cellOf, minlength=count),
+                             'tris':tris, 'triColours':[tuple(c) for c in triColours.astype(int).tolist()],
+                             'links':links, 'linkColours':[tuple(c) for c in linkColours.astype(int).tolist()] }
+        return self.coarseCache
+
+
+    def update(self, dt=1):
+        if self.asleep:
+            return
+        self.vel += self.pushes() * dt
+        self.drag(dt)
+        self.stillSleeping()
+
+    def stillSleeping(self):
+        if self.sleeping is not None:
+            self.vel[self.sleeping] = 0
+
+    def pushes(self, links=True):
+        #velocity change per unit time from links, repulsion and gravity
+        #links=False leaves out the springs but keeps the links' damping
+        pos = self.pos
+        config = self.config
+        maxClose = config.maxClose
+
+        if links:
+            forces = springForces( pos, self.linkStart, self.linkEnd, self.linkEnds,
+                                   self.linkLength*self.linkExtMult, self.linkK )
+        else:
+            forces = np.zeros( len(pos), dtype=complex )
+        if self.linkDamping.any():
+            forces += dampingForces( pos, self.vel, self.linkStart, self.linkEnd, self.linkEnds, self.linkDamping )
+
+        i,j = self.closePairs()
+        dis = pos[i] - pos[j]
+        d = np.abs(dis)
+        close = d<maxClose
+        i,j,dis,d = i[close], j[close], dis[close], d[close]
+        force = dis * (maxClose-d)**2 * config.closeMult
+        forces += scatterAdd( np.concatenate((i,j)), np.concatenate((force,-force)), len(pos) )
+
+        if self.sleeping is not None:
+            touching = self.sleeping[i] != self.sleeping[j]
+            self.wake( self.islandOf[ np.concatenate((i[touching],j[touching])) ] )
+
+        if config.selfContact == 'links':
+            forces += self.linkRepulsion()
+
+        return forces/self.nodeMass - .3j * config.air
+
+    def linkRepulsion(self):
+        #pushes nodes off links they aren't an end of or linked to either end of, the link's
+        #ends taking the reaction, closest to an end is left to the node to node repulsion
+        #the link tree is built once and refit to where the links are each step
+        #pairs already in reach when it's built are part of the jelly's own shape and only get
+        #the soft repulsion, others are pushed apart hard enough to stop nodes going through
+        pos = self.pos
+        config = self.config
+        start, end, n = self.linkStart, self.linkEnd, len(pos)
+        if self.linkTree is None:
+            self.linkTree = SegmentTree( pos[start], pos[end] )
+            self.linkedPairs = np.unique( np.concatenate((start*n+end, end*n+start)) )
+            self.restingPairs = None
+        else:
+            self.linkTree.refit( pos[start], pos[end] )
+
+        i,l = self.linkTree.query( pos, config.maxClose )
+        other = (i != start[l]) & (i != end[l])
+        i,l = i[other], l[other]
+        apart = ~np.isin( i*n+start[l], self.linkedPairs ) & ~np.isin( i*n+end[l], self.linkedPairs )
+        i,l = i[apart], l[apart]
+        if self.restingPairs is None:
+            self.restingPairs = np.unique( i*len(start)+l )
+        maxClose = config.maxClose
+        dis, t = segmentOffsets( pos[i], pos[start[l]], pos[end[l]] )
+        d = np.abs(dis)
+        close = (d<maxClose) & (t > 0) & (t < 1)
+        i, l, t, dis, d = i[close], l[close], t[close], dis[close], d[close]
+        resting = np.isin( i*len(start)+l, self.restingPairs )
+        force = np.where( resting, dis * (maxClose-d)**2 * config.closeMult,
+                          dis/np.maximum(d,1e-12) * (maxClose-d) * config.selfStiffness )
+        ends = np.concatenate( (start[l],end[l]) )
+
+        if self.sleeping is not None:
+            touching = (self.sleeping[i] != self.sleeping[start[l]]) | (self.sleeping[i] != self.sleeping[end[l]])
+            self.wake( self.islandOf[ np.concatenate((i[touching],start[l][touching],end[l][touching])) ] )
+
+        return ( scatterAdd( i, force, len(pos) )
+                 - scatterAdd( ends, np.concatenate(((1-t)*force,t*force)), len(pos) ) )
+
+    def implicitUpdate(self, dt=1):
+        #backward euler for the links, solving (M + dt C + dt^2 K) dv = dt f - dt^2 K v
+        #where K and C are the spring stiffness and damping matrices, applied without ever building them
+        if self.asleep:
+            return
+        start, end, n = self.linkStart, self.linkEnd, len(self.pos)
+
+        delta = self.pos[start] - self.pos[end]
+        dist = np.abs(delta)
+        direction = delta/dist
+        soft = self.linkK * np.maximum( 0, 1 - self.linkLength*self.linkExtMult/dist )
+        along = self.linkK - soft
+
+        def stiffness(u):
+            du = u[start] - u[end]
+            f = soft*du + along*direction*(direction.conjugate()*du).real
+            return scatterAdd( self.linkEnds, np.concatenate((f,-f)), n )
+
+        def damping(u):
+            du = u[start] - u[end]
+            f = self.linkDamping*direction*(direction.conjugate()*du).real
+            return scatterAdd( self.linkEnds, np.concatenate((f,-f)), n )
+
+        damped = self.linkDamping.any()
+        def system(u):
+            return self.nodeMass*u + dt*dt*stiffness(u) + (dt*damping(u) if damped else 0)
+
+        rhs = dt*self.nodeMass*self.pushes() - dt*dt*stiffness(self.vel)
+        if self.guess is None:
+            self.guess = np.zeros(n, dtype=complex)
+        self.guess, iterations = conjugateGradient( system, rhs, self.guess,
+                                                    self.config.cgIterations, self.config.cgTolerance )
+
+        self.vel += self.guess
+        self.drag(dt)
+        self.stillSleeping()
+        self.stats['cgIterations'] += iterations
+        self.stats['cgSolves'] += 1
+
+    def predict(self, dt=1):
+        #xpbd, moves nodes by everything except links and keeps where they started,
+        #scenery notes what it touches until the step settles
+        self.lambdas = np.zeros( len(self.links) )
+        self.contacts = []
+        if self.asleep:
+            return
+        self.vel += self.pushes(links=False) * dt
+        self.drag(dt)
+        self.stillSleeping()
+        self.startPos = self.pos.copy()
+        self.pos += self.vel * dt
+
+    def solveLinks(self, iteration, dt=1):
+        #one gauss-seidel pass over the link constraints a colour at a time,
+        #groups stop after their iteration count
+        if self.asleep:
+            return
+        pos = self.pos
+        rest = self.linkLength*self.linkExtMult
+        alpha = self.linkCompliance/self.linkK/(dt*dt)
+        active = self.linkIterations > iteration
+        w = 1/self.nodeMass
+
+        for batch,start,end in self.linkColours():
+            delta = pos[start] - pos[end]
+            dist = np.abs(delta)
+            error = dist - rest[batch]
+            change = (-error - alpha[batch]*self.lambdas[batch]) / (w[start]+w[end]+alpha[batch]) * active[batch]
+            self.lambdas[batch] += change
+
+            correction = change * delta/dist
+            pos[start] += w[start]*correction
+            pos[end]   -= w[end]*correction
+
+    def settle(self, dt=1):
+        contacts, self.contacts = self.contacts, None
+        if self.asleep:
+            return
+        if self.sleeping is not None:
+            self.pos[self.sleeping] = self.startPos[self.sleeping]
+        self.vel[:] = (self.pos - self.startPos) / dt
+
+        #moving nodes out of scenery stopped them, but friction and bounce go by how fast
+        #they were going into it, so they're put back on the velocities they settled with
+        vel = self.vel
+        for scenery, nodes, normal, before in contacts:
+            stopped = np.maximum( -(normal.conjugate()*before).real, 0 )
+            vel[nodes] = contactVelocity( vel[nodes] - stopped*normal, normal, scenery.friction, scenery.bounce )
+
+    def drag(self, dt=1):
+        #drag is a force, so heavier nodes slow less
+        vel = self.vel
+        vel -= (vel*self.config.linDrag + vel*np.abs(vel)*self.config.quadDrag) / self.nodeMass * dt
+
+    def closePairs(self):
+        #candidate pairs for repulsion, every pair within maxClose is included
+        repulsion = self.config.repulsion
+
+        if repulsion == 'brute':
+            return np.triu_indices( len(self.pos), 1 )
+
+        if self.gridOrder is not None and len(self.gridOrder) != len(self.pos):
+            self.gridOrder = None
+
+        if repulsion == 'grid':
+            i,j,self.gridOrder = gridPairs( self.pos, self.config.maxClose, self.gridOrder )
+            return i,j
+
+        self.stats['pairSteps'] += 1
+        if self.pairs is None or len(self.pos) and self.pairsMoved() > self.config.skin/2:
+            self.rebuildPairs()
+        return self.pairs
+
+    def pairsMoved(self):
+        #pairs only see relative movement, so moving the whole jelly doesn't count
+        moved = self.pos - self.pairsPos
+        return np.abs( moved - moved.mean() ).max()
+
+    def rebuildPairs(self):
+        reach = self.config.maxClose + self.config.skin
+        i,j,self.gridOrder = gridPairs( self.pos, reach, self.gridOrder )
+        near = np.abs(self.pos[i]-self.pos[j]) < reach
+        self.pairs = i[near], j[near]
+        self.pairsPos = self.pos.copy()
+        self.stats['pairRebuilds'] += 1
+
+    def move(self, dt=1):
+        if not self.asleep:
+            self.pos += self.vel * dt
+
+
+class JellyBatch():
+    #many independent copies of one jelly stepped together, node state is (copies,nodes)
+    #drag, repulsion, gravity, link stiffness, damping and link lengths can differ between copies
+
+    def __init__(self, filename, copies, floor=FLOORHEIGHT, config=None):
+
+        self.config = config = config if config else defaultConfig
+        jelly = Jelly(filename,config)
+        self.template = jelly
+        self.copies = copies
+        nodes = len(jelly.nodes)
+
+        self.pos = np.tile( jelly.pos, (copies,1) )
+        self.vel = np.tile( jelly.vel, (copies,1) )
+
+        self.linkStart, self.linkEnd = jelly.linkStart, jelly.linkEnd
+        self.linkLength = jelly.linkLength
+        self.linkControls = jelly.linkControls
+        self.linkK = np.tile( jelly.linkK, (copies,1) )
+        self.linkDamping = np.tile( jelly.linkDamping, (copies,1) )
+        self.linkExtMult = np.ones( (copies,len(jelly.links)) )
+        self.nodeMass = jelly.nodeMass
+
+        #flat indices into the (copies,nodes) arrays
+        rows = np.arange(copies)[:,None]*nodes
+        self.flatEnds = np.concatenate( (rows+self.linkStart, rows+self.linkEnd), axis=1 ).ravel()
+        self.copyOf = np.repeat( np.arange(copies), nodes )
+
+        self.air = np.full( (copies,1), float(config.air) )
+        self.linDrag = np.full( (copies,1), config.linDrag )
+        self.quadDrag = np.full( (copies,1), config.quadDrag )
+        self.closeMult = np.full( copies, config.closeMult )
+
+        self.floor = floor if isinstance(floor,Terrain) else Floor(floor,config)
+        self.sweptFrom = None
+        assert config.integrator in ('legacy','euler'), 'batches only step with the legacy or euler integrator'
+        self.integrator = config.integrator
+        self.pairs = None
+        self.gridOrder = None
+        self.stats = {'pairRebuilds':0, 'copyRebuilds':0, 'pairSteps':0}
+
+
+    def setControl(self, control, mult):
+        #mult is the extension multiplier each copy gives the links under that control
+        group = self.linkControls == control
+        self.linkExtMult[:,group] = np.asarray(mult, dtype=float).reshape(-1,1)
+
+
+    def step(self, dt=1):
+        self.update(dt)
+        self.move(dt)
+        self.collide()
+        if self.integrator == 'legacy':
+            self.move(dt)
+
+
+    def update(self, dt=1):
+        pos, vel = self.pos, self.vel
+        size = pos.size
+        maxClose = self.config.maxClose
+
+        delta = pos[:,self.linkStart] - pos[:,self.linkEnd]
+        dist = np.abs(delta)
+        forceVector = self.linkK*(1 - self.linkLength*self.linkExtMult/dist) * delta
+        if self.linkDamping.any():
+            direction = delta/dist
+            apart = vel[:,self.linkStart] - vel[:,self.linkEnd]
+            forceVector += self.linkDamping * direction * (direction.conjugate()*apart).real
+        forces = scatterAdd( self.flatEnds, np.concatenate((-forceVector,forceVector),axis=1).ravel(), size )
+
+        flat = pos.ravel()
+        i,j = self.closePairs()
+        dis = flat[i] - flat[j]
+        d = np.abs(dis)
+        close = d<maxClose
+        i,j,dis,d = i[close], j[close], dis[close], d[close]
+        force = dis * (maxClose-d)**2 * self.closeMult[self.copyOf[i]]
+        forces += scatterAdd( np.concatenate((i,j)), np.concatenate((force,-force)), size )
+
+        vel += forces.reshape(pos.shape) / self.nodeMass * dt
+        vel -= .3j * self.air * dt
+        vel -= (vel*self.linDrag + vel*np.abs(vel)*self.quadDrag) / self.nodeMass * dt
+
+
+    def closePairs(self):
+        #verlet pair list over every copy at once, copies are kept apart in the grid
+        #only the copies that have moved far enough since their pairs were found are redone
+        flat = self.pos.ravel()
+        reach = self.config.maxClose + self.config.skin
+        self.stats['pairSteps'] += 1
+
+        if self.pairs is None:
+            i,j,self.gridOrder = gridPairs( flat, reach, self.gridOrder, groups=self.copyOf )
+            near = np.abs(flat[i]-flat[j]) < reach
+            self.pairs = i[near], j[near]
+            self.pairsPos = self.pos.copy()
+            self.stats['pairRebuilds'] += 1
+            self.stats['copyRebuilds'] += self.copies
+            return self.pairs
+
+        moved = self.pos - self.pairsPos
+        moved -= moved.mean(axis=1, keepdims=True)
+        redo = np.flatnonzero( np.abs(moved).max(axis=1, initial=0) > self.config.skin/2 )
+        if len(redo):
+            nodes = self.pos.shape[1]
+            index = ( redo[:,None]*nodes + np.arange(nodes) ).ravel()
+            i,j,_ = gridPairs( flat[index], reach, groups=self.copyOf[index] )
+            i,j = index[i], index[j]
+            near = np.abs(flat[i]-flat[j]) < reach
+
+            redoing = np.zeros( self.copies, dtype=bool )
+            redoing[redo] = True
+            keep = ~redoing[ self.copyOf[self.pairs[0]] ]
+            self.pairs = ( np.concatenate((self.pairs[0][keep], i[near])),
+                           np.concatenate((self.pairs[1][keep], j[near])) )
+            self.pairsPos[redo] = self.pos[redo]
+            self.stats['pairRebuilds'] += 1
+            self.stats['copyRebuilds'] += len(redo)
+        return self.pairs
+
+
+    def move(self, dt=1):
+        self.pos += self.vel * dt
+
+
+    def collide(self):
+        if self.config.sweep and self.sweptFrom is not None:
+            self.floor.sweep( self.sweptFrom, self.pos, self.vel )
+        self.floor.push( self.pos, self.vel )
+        self.sweptFrom = self.pos.copy()
+
+
+    def centres(self):
+        #centre of mass of each copy
+        return np.average( self.pos, weights=self.nodeMass, axis=-1 )
+        
 
-        for thingList in toDraw:
-            for thing in thingList:
-                thing.draw(surf,world)
+class ArrayField():
+    #attribute kept in an array of the jelly an object is packed into, or on the object while loose
 
+    def __init__(self, array, cast):
+        self.array = array
+        self.cast = cast
 
-    def update(self):
-        for link in self.links:
-            link.pull()
+    def __set_name__(self, owner, name):
+        self.name = '_'+name
 
-        for i in range(len(self.nodes)):
-            for j in range(i+1,len(self.nodes)):
-                dis = self.nodes[i].pos - self.nodes[j].pos
-                if abs(dis)<MAXCLOSE:
-                    force = dis * (MAXCLOSE-abs(dis))**2 * CLOSEMULT
-                    self.nodes[i].vel += force
-                    self.nodes[j].vel -= force
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if obj.jelly is None:
+            return obj.__dict__[self.name]
+        return self.cast( getattr(obj.jelly,self.array)[obj.index] )
 
-        for node in self.nodes:
-            node.update()
+    def __set__(self, obj, value):
+        if obj.jelly is None:
+            obj.__dict__[self.name] = value
+        else:
+            getattr(obj.jelly,self.array)[obj.index] = value
 
-    def move(self):
-        for node in self.nodes:
-            node.move()
-        
 
 class Node():
 
-    def __init__(self, pos, vel=0):
+    pos  = ArrayField('pos',complex)
+    vel  = ArrayField('vel',complex)
+    mass = ArrayField('nodeMass',float)
+
+    def __init__(self, pos, vel=0, mass=NODEMASS):
+        self.jelly = None
+        self.index = None
         self.pos = pos
         self.vel = vel
+        self.mass = mass
         self.connected = []
 
+    @property
+    def config(self):
+        return self.jelly.config if self.jelly else defaultConfig
+
     def connect(self,other):
         self.connected.append( other )
         other.connected.append( self )
-        return( Link(self,other) )
-
-    def update(self):
-        self.vel -= .3j * AIR
-        drag = self.vel*LINDRAG + self.vel*abs(self.vel)*QUADRAG
-        if False:
-        #if abs(drag)>abs(self.vel):
-            self.vel = 0
-        else:
-            self.vel -= drag
-
-    def move(self):
-        self.pos += self.vel
+        return( Link(self,other,k=self.config.linkK,damping=self.config.linkDamping) )
 
-    def draw(self, surf, world):
-        pygame.draw.circle(surf,(255,255,255), world.toScreen(self.pos), 3)
+    def draw(self, surf, world, screen=None):
+        at = screen[self.index] if screen else world.toScreen(self.pos)
+        pygame.draw.circle(surf,(255,255,255), at, NODERADIUS)
 
 
 class Link():
 
-    def __init__(self, start, end, length=0, control=0):
+    length  = ArrayField('linkLength',float)
+    k       = ArrayField('linkK',float)
+    damping = ArrayField('linkDamping',float)
+    extMult = ArrayField('linkExtMult',float)
+
+    def __init__(self, start, end, length=0, control=0, k=LINKK, damping=LINKDAMPING):
+
+        self.jelly = None
+        self.index = None
 
         self.start = start
         self.end = end
 
         self.extMult = 1
-        self.k = 0.069
+        self.k = k
+        self.damping = damping
         self.control = control
         
         self.length = length if length else abs(self.start.pos-self.end.pos)
         assert self.length>0
 
-    def draw(self, surf, world):
-        pygame.draw.line(surf,(255,255,255) ,world.toScreen(self.start.pos),world.toScreen(self.end.pos) )
-
-    def pull(self):
-        ext = abs(self.start.pos-self.end.pos) - self.length*self.extMult
-        force = self.k * ext
-        direction = (self.start.pos-self.end.pos)/abs(self.start.pos-self.end.pos)
+    def unbind(self):
+        length, k, damping, extMult = self.length, self.k, self.damping, self.extMult
+        self.jelly = self.index = None
+        self.length, self.k, self.damping, self.extMult = length, k, damping, extMult
 
-        forceVector = force * direction
-        #print(ext,force,direction,forceVector,'\n')
-        self.start.vel -= forceVector
-        self.end.vel   += forceVector
+    def draw(self, surf, world, screen=None):
+        if screen:
+            pygame.draw.line(surf,(255,255,255) ,screen[self.start.index],screen[self.end.index] )
+        else:
+            pygame.draw.line(surf,(255,255,255) ,world.toScreen(self.start.pos),world.toScreen(self.end.pos) )
 
 
 class Tri():
@@ -211,11 +1526,265 @@ class Tri():
         self.points = points
         self.colour = colour
 
-    def draw(self, surf, world):
-        pygame.draw.polygon(surf,self.colour, [world.toScreen(p.pos) for p in self.points] )
+    def draw(self, surf, world, screen=None):
+        if screen:
+            pygame.draw.polygon(surf,self.colour, [screen[p.index] for p in self.points] )
+        else:
+            pygame.draw.polygon(surf,self.colour, [world.toScreen(p.pos) for p in self.points] )
      
 
 
+class SegmentTree():
+    #bounding box tree over segments, built once and refit as the segments move
+    #a complete binary tree, box k has children 2k and 2k+1 and the leaves are the last half
+
+    def __init__(self, a, b):
+        self.order = mortonOrder( (a+b)/2 )
+        self.leaves = 1 << int( np.ceil(np.log2( max(len(a),1) )) )
+        self.low = np.empty( (2, 2*self.leaves) )
+        self.high = np.empty( (2, 2*self.leaves) )
+        self.refit(a, b)
+
+    def refit(self, a, b):
+        #leaf boxes from the segments, then each level from the one below
+        low, high, n = self.low, self.high, self.leaves
+        a, b = a[self.order], b[self.order]
+        low[:,n:], high[:,n:] = np.inf, -np.inf
+        low[0,n:n+len(a)], high[0,n:n+len(a)] = np.minimum(a.real,b.real), np.maximum(a.real,b.real)
+        low[1,n:n+len(a)], high[1,n:n+len(a)] = np.minimum(a.imag,b.imag), np.maximum(a.imag,b.imag)
+        while n > 1:
+            low[:,n//2:n] = np.minimum( low[:,n:2*n:2], low[:,n+1:2*n:2] )
+            high[:,n//2:n] = np.maximum( high[:,n:2*n:2], high[:,n+1:2*n:2] )
+            n //= 2
+
+    def query(self, points, reach):
+        #pairs of (point, segment) with the point within reach of the segment's box
+        x, y = points.real, points.imag
+        return self.overlapping( x-reach, x+reach, y-reach, y+reach )
+
+    def overlapping(self, left, right, bottom, top):
+        #pairs of (query, segment) whose boxes overlap, every query box walks down
+        #the tree together a level at a time
+        low, high = self.low, self.high
+        query = np.arange( len(left) )
+        box = np.ones( len(left), dtype=int )
+        while True:
+            hit = ( (low[0,box] <= right[query]) & (high[0,box] >= left[query]) &
+                    (low[1,box] <= top[query]) & (high[1,box] >= bottom[query]) )
+            query, box = query[hit], box[hit]
+            if not len(box) or box[0] >= self.leaves:
+                return query, self.order[ box-self.leaves ]
+            query = np.repeat( query, 2 )
+            box = ( 2*box[:,None] + [0,1] ).ravel()
+
+
+def scatterAdd(index, values, n):
+    #sums complex values into n bins, bincount being much faster than np.add.at
+    return np.bincount(index, values.real, n) + 1j*np.bincount(index, values.imag, n)
+
+
+def contactPushes(dis, relVel, invMass, reach, stiffness):
+    #how far to move each pair apart along their offset dis, stiffness of the way to reach, and the
+    #impulse that stops them closing, both still to be shared out by each end's inverse mass
+    d = np.abs(dis)
+    normal = dis / np.maximum(d, 1e-12)
+    into = (normal.conjugate()*relVel).real
+    return normal * stiffness*(reach-d) / invMass, normal * np.maximum(-into, 0) / invMass
+
+
+def contactCounts(index, n):
+    #how many contacts each of n nodes is in, at least 1, pushes are averaged over them
+    #so a node touching several at once isn't moved away several times over
+    return np.maximum( np.bincount(index, minlength=n), 1 )
+
+
+def springForces(pos, start, end, ends, rest, k):
+    #force on every node from all links at once, ends is start and end joined
+    delta = pos[start] - pos[end]
+    dist = np.abs(delta)
+    forceVector = k*(1-rest/dist) * delta
+    return scatterAdd( ends, np.concatenate((-forceVector,forceVector)), len(pos) )
+
+
+def dampingForces(pos, vel, start, end, ends, damping):
+    #force on every node from all links resisting their ends moving apart or together
+    delta = pos[start] - pos[end]
+    direction = delta/np.abs(delta)
+    apart = ( (vel[start]-vel[end]) * direction.conjugate() ).real
+    forceVector = damping * apart * direction
+    return scatterAdd( ends, np.concatenate((-forceVector,forceVector)), len(pos) )
+
+
+def linkIslands(start, end, n):
+    #numbers the groups of nodes joined by links, returning each node's group
+    labels = np.arange(n)
+    while True:
+        lowest = np.minimum( labels[start], labels[end] )
+        joined = labels.copy()
+        np.minimum.at( joined, start, lowest )
+        np.minimum.at( joined, end, lowest )
+        joined = joined[joined]
+        if (joined == labels).all():
+            return np.unique( labels, return_inverse=True )[1]
+        labels = joined
+
+
+def segmentOffsets(p, a, b):
+    #offset of points p from the closest point on segments a to b, along with
+    #how far along each segment that point is
+    along = b - a
+    t = np.clip( (along.conjugate()*(p-a)).real / np.maximum(np.abs(along)**2, 1e-12), 0, 1 )
+    return p - (a + t*along), t
+
+
+def contactVelocity(vel, normal, friction, bounce=0):
+    #velocity after touching a surface, sliding along it slowed by friction times the speed
+    #that was stopped, and bounce times the speed going into it sent back out
+    into = (normal.conjugate()*vel).real
+    slide = vel - into*normal
+    speed = np.abs(slide)
+    return ( slide * np.maximum( 0, 1 - friction*np.abs(into)/np.maximum(speed,1e-12) )
+             - bounce * np.minimum(into,0) * normal )
+
+
+def mortonOrder(pos):
+    #order of points along a z curve, points near in the order are mostly near in space
+    if not len(pos):
+        return np.zeros(0, dtype=int)
+    x, y = pos.real-pos.real.min(), pos.imag-pos.imag.min()
+    scale = 65535 / max( x.max(), y.max(), 1e-9 )
+
+    def spread(v):
+        v = v.astype(np.int64)
+        v = (v | v<<8) & 0x00FF00FF
+        v = (v | v<<4) & 0x0F0F0F0F
+        v = (v | v<<2) & 0x33333333
+        return (v | v<<1) & 0x55555555
+
+    return np.argsort( spread(x*scale) | spread(y*scale)<<1, kind='stable' )
+
+
+def colourLinks(start, end, n):
+    #greedy edge colouring, returns the links of each colour, no two sharing a node
+
+    used = [0]*n #bit c set if the node has a link of colour c
+    colours = np.zeros( len(start), dtype=int )
+    for i,(s,e) in enumerate( zip(start.tolist(),end.tolist()) ):
+        taken = used[s] | used[e]
+        free = ~taken & (taken+1)
+        colours[i] = free.bit_length()-1
+        used[s] |= free
+        used[e] |= free
+
+    return [ np.flatnonzero(colours==c) for c in range(colours.max(initial=-1)+1) ]
+
+
+def conjugateGradient(system, rhs, guess, iterations=CGITERATIONS, tolerance=CGTOLERANCE):
+    #solves system(x) = rhs for a symmetric positive definite system given as a function,
+    #complex arrays standing for 2d vectors, returns x and the iterations taken
+
+    dot = lambda a,b: np.vdot(a,b).real
+    x = guess.copy()
+    residual = rhs - system(x)
+    direction = residual.copy()
+    size = dot(residual,residual)
+    target = tolerance*tolerance * max( dot(rhs,rhs), 1e-30 )
+
+    for i in range(iterations):
+        if size <= target:
+            return x, i
+        product = system(direction)
+        step = size / dot(direction,product)
+        x += step*direction
+        residual -= step*product
+        newSize = dot(residual,residual)
+        direction = residual + (newSize/size)*direction
+        size = newSize
+    return x, iterations
+
+
+def gridPairs(pos, cellSize, order=None, groups=None):
+    #pairs of points in the same or neighbouring grid cells, each pair once
+    #order is the cell sorting from last time, which is nearly sorted already
+    #points in different groups are never paired
+
+    n = len(pos)
+    cx = np.floor(pos.real/cellSize).astype(np.int64)
+    cy = np.floor(pos.imag/cellSize).astype(np.int64)
+    cx -= cx.min() if n else 0
+    if groups is not None and n:
+        cx += groups * (cx.max()+2)
+    cy -= cy.min()-1 if n else 0
+    height = cy.max()+2 if n else 1
+    keys = cx*height + cy
+
+    if order is None:
+        order = np.argsort(keys, kind='stable')
+    else:
+        order = order[ np.argsort(keys[order], kind='stable') ]
+    keys = keys[order]
+
+    #occupied cells, where each starts in the sorted points and how many it holds
+    cellStart = np.flatnonzero( np.diff(keys, prepend=-1) )
+    cellSize = np.diff( cellStart, append=n )
+    cells = keys[cellStart]
+    cellOf = np.repeat( np.arange(len(cells)), cellSize )
+
+    starts,ends = [],[]
+    for offset in (0, height-1, height, height+1, 1):
+        if offset==0:
+            lo = np.arange(n)+1
+            counts = (cellStart+cellSize)[cellOf] - lo
+        else:
+            other = np.minimum( np.searchsorted(cells, cells+offset), len(cells)-1 )
+            found = cells[other] == cells+offset
+            lo = cellStart[other][cellOf]
+            counts = (cellSize[other]*found)[cellOf]
+        first = np.repeat( np.cumsum(counts)-counts, counts )
+        starts.append( np.repeat( np.arange(n), counts ) )
+        ends.append( np.repeat( lo, counts ) + np.arange(counts.sum()) - first )
+
+    i,j = np.concatenate(starts), np.concatenate(ends)
+    return order[i], order[j], order
+
+
+def segmentGridPairs(points, a, b, reach):
+    #pairs of (point, segment a to b) that might be within reach of each other
+    #each segment is put in every grid cell its padded box covers
+
+    if not len(points) or not len(a):
+        return np.zeros(0,dtype=int), np.zeros(0,dtype=int)
+
+    cellSize = max( reach, np.median(np.abs(b-a)) )
+    low = np.minimum(a.real,b.real) - reach + 1j*(np.minimum(a.imag,b.imag) - reach)
+    high = np.maximum(a.real,b.real) + reach + 1j*(np.maximum(a.imag,b.imag) + reach)
+    x0, x1 = np.floor(low.real/cellSize).astype(np.int64), np.floor(high.real/cellSize).astype(np.int64)
+    y0, y1 = np.floor(low.imag/cellSize).astype(np.int64), np.floor(high.imag/cellSize).astype(np.int64)
+    px, py = np.floor(points.real/cellSize).astype(np.int64), np.floor(points.imag/cellSize).astype(np.int64)
+
+    left, bottom = min(x0.min(),px.min()), min(y0.min(),py.min())
+    height = max(y1.max(),py.max()) - bottom + 1
+
+    #every (cell, segment) the segments cover
+    wide, tall = x1-x0+1, y1-y0+1
+    counts = wide*tall
+    segment = np.repeat( np.arange(len(a)), counts )
+    k = np.arange(counts.sum()) - np.repeat( np.cumsum(counts)-counts, counts )
+    cx = x0[segment] + k // tall[segment]
+    cy = y0[segment] + k % tall[segment]
+    keys = (cx-left)*height + (cy-bottom)
+    order = np.argsort(keys, kind='stable')
+    keys, segment = keys[order], segment[order]
+
+    pointKeys = (px-left)*height + (py-bottom)
+    lo = np.searchsorted( keys, pointKeys, 'left' )
+    hi = np.searchsorted( keys, pointKeys, 'right' )
+    counts = hi-lo
+    point = np.repeat( np.arange(len(points)), counts )
+    k = np.arange(counts.sum()) - np.repeat( np.cumsum(counts)-counts, counts )
+    return point, segment[ np.repeat(lo,counts) + k ]
+
+
 def inputFile(filetype):
     from os import walk, getcwd
 
@@ -237,24 +1806,31 @@ def inputFile(filetype):
 
 
 def loadJelly( filename, jelly ):
+    #filename can also be an already open file
 
     jelly.nodes = []
     jelly.links = []
     jelly.tris  = []
     
-    with open(filename,'r') as theFile:
+    with open(filename,'r') if isinstance(filename,str) else filename as theFile:
 
+        #nodes may have a mass after their position, links a stiffness and damping at the end
         nextLine = theFile.readline()[:-1]
         while nextLine:
-            real,imag = [int(n) for n in nextLine.split(' ')]
-            jelly.nodes.append( Node(real+imag*1j) )
+            values = nextLine.split(' ')
+            real,imag = [int(n) for n in values[:2]]
+            mass = float(values[2]) if len(values)>2 else NODEMASS
+            jelly.nodes.append( Node(real+imag*1j, mass=mass) )
             nextLine = theFile.readline()[:-1]
             
         nextLine = theFile.readline()[:-1]
         while nextLine:
-            start,end,length,control = [int(n) for n in nextLine.split(' ')]
+            values = nextLine.split(' ')
+            start,end,length,control = [int(n) for n in values[:4]]
+            k = float(values[4]) if len(values)>4 else jelly.config.linkK
+            damping = float(values[5]) if len(values)>5 else jelly.config.linkDamping
             start,end = jelly.nodes[start], jelly.nodes[end]
-            jelly.links.append( Link(start,end,length=length,control=control) )
+            jelly.links.append( Link(start,end,length=length,control=control,k=k,damping=damping) )
             nextLine = theFile.readline()[:-1]
             
         nextLine = theFile.readline()[:-1]
@@ -265,6 +1841,38 @@ def loadJelly( filename, jelly ):
             nextLine = theFile.readline()[:-1]
 
 
+def loadTerrain( filename, config=None ):
+    #a line of x and height for each point of the profile, filename can also be an open file
+
+    xs, heights = [], []
+    with open(filename,'r') if isinstance(filename,str) else filename as theFile:
+        for line in theFile:
+            if line.strip():
+                x,height = [float(n) for n in line.split()]
+                xs.append(x)
+                heights.append(height)
+
+    return Terrain( xs, heights, config=config )
+
+
+def loadRocks( filename, config=None ):
+    #a line of x and y for each corner, polygons are separated by empty lines
+
+    polygons, corners = [], []
+    with open(filename,'r') if isinstance(filename,str) else filename as theFile:
+        for line in theFile:
+            if line.strip():
+                x,y = [float(n) for n in line.split()]
+                corners.append( x+y*1j )
+            elif corners:
+                polygons.append(corners)
+                corners = []
+    if corners:
+        polygons.append(corners)
+
+    return Rocks( polygons, config=config )
+
+
 def saveJelly(world):
 
     filename = input('Enter filename to save to or enter to not save: ')
@@ -276,7 +1884,8 @@ def saveJelly(world):
         for node in world.cont[0].nodes:
             real = int(node.pos.real)
             imag = int(node.pos.imag)
-            line = ' '.join([str(prop) for prop in [real,imag]])
+            props = [real,imag] + ([node.mass] if node.mass != NODEMASS else [])
+            line = ' '.join([str(prop) for prop in props])
             theFile.write(line+'\n')
 
         theFile.write('\n')
@@ -285,7 +1894,11 @@ def saveJelly(world):
             start = world.cont[0].nodes.index(link.start)
             end   = world.cont[0].nodes.index(link.end  )
             length = int(link.length)
-            line = ' '.join([str(prop) for prop in [start,end,length,link.control]])
+            props = [start,end,length,link.control]
+            config = world.cont[0].config
+            if link.k != config.linkK or link.damping != config.linkDamping:
+                props += [link.k,link.damping]
+            line = ' '.join([str(prop) for prop in props])
             theFile.write(line+'\n')
 
         theFile.write('\n')
@@ -299,29 +1912,43 @@ def saveJelly(world):
             theFile.write(line+'\n')
 
            
-def main():
+def main(threaded=THREADED):
 
     filename = inputFile('.txt')
     
     world = World(filename)
+    world.attachWindow()
 
     clock = pygame.time.Clock()
     running = True
 
     clicked = {0:0,1:0,2:0,'s':[],'d':[],'q':[],'e':[]}
 
+    if threaded:
+        physics = PhysicsThread(world)
+        physics.start()
+
     while running:
 
-        clock.tick(30)
+        seconds = clock.tick(DRAWRATE if threaded else 0)/1000
 
-        running = handleEvents(world,clicked)
+        if threaded:
+            physics.check()
+            #edits wait for the physics thread, then show straight away
+            with world.lock:
+                running = handleEvents(world,clicked)
+                world.publish()
+        else:
+            running = handleEvents(world,clicked)
         if not running:
             break
         
-        world.frame()
+        if not threaded:
+            world.advance(seconds)
         world.draw()
         
-
+    if threaded:
+        physics.stop()
     saveJelly(world)
 
 
@@ -342,11 +1969,11 @@ def handleEvents(world,clicked):
                 closest = min( world.cont[0].nodes, key = lambda n: abs(n.pos-mousePos) )
                 closestDis = abs(closest.pos-mousePos)
                 if closestDis > 20:
-                    world.cont[0].nodes.append( Node(mousePos) )
+                    world.cont[0].addNode( mousePos )
                 else:
                     if clicked[2]:
                         if clicked[2] != closest:
-                            world.cont[0].links.append( closest.connect(clicked[2]) )
+                            world.cont[0].addLink( closest, clicked[2] )
                         clicked[2]=0
                     else:
                         clicked[2]=closest
@@ -367,8 +1994,7 @@ def handleEvents(world,clicked):
         elif event.type == pygame.KEYDOWN:
             
             if event.key == pygame.K_a:
-                global AIR
-                AIR = not AIR
+                world.config.air = not world.config.air
                 
             if event.key == pygame.K_s:
                 mx,my = pygame.mouse.get_pos()
@@ -427,32 +2053,171 @@ def handleEvents(world,clicked):
         clicked['s'] = []
 
     if len(clicked['d']) >= 2:
-        for link in world.cont[0].links:
+        for link in list(world.cont[0].links):
             if link.start in clicked['d'] and link.end in clicked['d']:
-                world.cont[0].links.remove(link)
-                link.start.connected.remove(link.end)
-                link.end.connected.remove(link.start)
+                world.cont[0].removeLink(link)
         clicked['d'] = []
 
     if len(clicked['q']) >= 2:
         for link in world.cont[0].links:
             if link.start in clicked['q'] and link.end in clicked['q']:
-                link.control = pygame.K_j
-                world.cont[0].controlLinks[pygame.K_j].append(link)
+                world.cont[0].setControl(link, pygame.K_j)
         clicked['q'] = []
 
     if len(clicked['e']) >= 2:
         for link in world.cont[0].links:
             if link.start in clicked['e'] and link.end in clicked['e']:
-                link.control = pygame.K_l
-                world.cont[0].controlLinks[pygame.K_l].append(link)
+                world.cont[0].setControl(link, pygame.K_l)
         clicked['e'] = []
 
     return True
 
 
+rolloutTopologies = {} #jelly files a rollout worker was started with, by name
+
+
+def runRollouts(jobs, processes=None):
+    #runs headless worlds across a process pool, each job being
+    #(jelly file, parameters, control schedule, steps)
+    #parameters are Config settings along with 'dt', linkK sets every link's stiffness
+    #the schedule maps a link control to extension multipliers per step, the last one held
+    #returns a dict of result arrays per job, in order
+
+    files = set( job[0] for job in jobs )
+    topologies = {}
+    for filename in files:
+        with open(filename,'r') as theFile:
+            topologies[filename] = theFile.read()
+
+    with multiprocessing.Pool( processes, initializer=startRolloutWorker, initargs=(topologies,) ) as pool:
+        return pool.map( rollout, jobs )
+
+
+def startRolloutWorker(topologies):
+    rolloutTopologies.update(topologies)
+
+
+def rollout(job):
+    filename, parameters, schedule, steps = job
+
+    parameters = dict(parameters)
+    dt = parameters.pop('dt', 1)
+    config = Config(**parameters)
+
+    world = World( io.StringIO(rolloutTopologies[filename]), config )
+    jelly = world.cont[0]
+    if 'linkK' in parameters:
+        jelly.linkK[:] = parameters['linkK']
+
+    controls = [ (jelly.linkControls==control, np.asarray(mults,dtype=float))
+                 for control,mults in schedule.items() ]
+    centres = np.zeros( steps, dtype=complex )
+    energy = np.zeros( steps )
+
+    for step in range(steps):
+        jelly.linkExtMult[:] = 1
+        for group,mults in controls:
+            jelly.linkExtMult[group] = mults[ min(step,len(mults)-1) ]
+        world.frame(dt)
+        centres[step] = np.average( jelly.pos, weights=jelly.nodeMass, axis=-1 )
+        energy[step] = jelly.energy()
+
+    return { 'final':jelly.pos.copy(), 'centres':centres, 'energy':energy }
+
+
+def benchmarkIntegrators(files=('tnoco.txt','noco.txt','ocoNew.txt'), dts=(.5,1,2,4,8),
+                         stiffness=(1,4,16), seconds=10):
+    #drops each jelly under gravity with every integrator and timestep, a run
+    #is unstable once any node goes faster than blowUp mm per frame, far past falling speed
+
+    blowUp = 50
+    print('file        integrator  k mult  dt    steps  stable  max speed  max strain  ms per sim second')
+
+    for filename in files:
+        for kMult in stiffness:
+            for integrator in INTEGRATORS:
+                for dt in dts:
+                    world = World( filename, Config(air=True, integrator=integrator) )
+                    jelly = world.cont[0]
+                    jelly.linkK *= kMult
+
+                    steps = int(seconds*FRAMERATE/dt)
+                    speed = strain = 0
+                    start = time.perf_counter()
+                    with np.errstate(all='ignore'):
+                        for step in range(steps):
+                            world.frame(dt)
+                            speed = max( speed, np.abs(jelly.vel).max(initial=0) )
+                            if not speed < blowUp:
+                                break
+                            length = np.abs( jelly.pos[jelly.linkStart]-jelly.pos[jelly.linkEnd] )
+                            strain = max( strain, np.abs(length/jelly.linkLength - 1).max(initial=0) )
+                    taken = time.perf_counter() - start
+
+                    stable = speed < blowUp
+                    print( '%-11s %-11s %-7g %-5g %-6d %-7s %-10.3g %-11.3g %.2f' %
+                           (filename, integrator, kMult, dt, step+1, stable, speed, strain,
+                            1000*taken/seconds) )
+
+
+def checkContacts():
+    #contact cases that have gone wrong before, run with every integrator
+
+    for integrator in INTEGRATORS:
+        config = Config(air=False, sleep=False, integrator=integrator)
+
+        #a node dropped onto a rock thinner than it falls in a step stays on top
+        world = World( io.StringIO('0 20\n\n\n'), config, terrain=None,
+                       rocks=io.StringIO('-50 -5\n50 -5\n50 0\n-50 0\n') )
+        jelly = world.cont[0]
+        for step in range(30):
+            jelly.vel -= 8j
+            world.frame()
+        assert abs(jelly.pos[0].imag) < 1e-6, (integrator, 'fell through a thin rock', jelly.pos[0])
+
+        #friction slows a node sliding along the ground by as much whatever the integrator
+        sliding = Config(air=True, linDrag=0, quadDrag=0, sleep=False, integrator=integrator)
+        world = World( io.StringIO('0 0\n\n\n'), sliding, terrain=None )
+        world.scenery = [ Terrain( [0], [0], friction=.3, config=sliding ) ]
+        jelly = world.cont[0]
+        jelly.vel[:] = 10
+        for step in range(30):
+            world.frame()
+        assert abs(jelly.vel[0] - 7.3) < 1e-6, (integrator, 'slid without friction', jelly.vel[0])
+
+        #with links self contact, a node thrown at one of its jelly's links bounces off it
+        for speed in (2,3,5):
+            thrown = Config(air=False, linDrag=0, quadDrag=0, sleep=False, integrator=integrator, selfContact='links')
+            world = World( io.StringIO('-50 0 100\n50 0 100\n0 30\n\n0 1 100 0\n\n'), thrown, terrain=None )
+            jelly = world.cont[0]
+            jelly.vel[2] = -speed*1j
+            for step in range(200):
+                world.frame(world.dt)
+            assert jelly.pos[2].imag > 0, (integrator, 'went through a link at', speed, jelly.pos[2])
+
+        #a jelly dropped 180 mm onto another lands on it rather than sinking in
+        world = World( 'ocoNew.txt', config )
+        world.cont.append( Jelly('ocoNew.txt', config) )
+        below, above = world.cont
+        above.pos += 1j*( np.ptp(below.pos.imag) + 180 )
+        closest = np.inf
+        for step in range(1200):
+            world.frame(world.dt)
+            for one,two in ((below,above),(above,below)):
+                dis,_ = segmentOffsets( one.pos[:,None], two.pos[two.linkStart], two.pos[two.linkEnd] )
+                closest = min( closest, np.abs(dis).min() )
+        assert closest > config.maxClose/2, (integrator, 'jellies sank into each other', closest)
+
+    print('contacts ok')
+
+
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['bench']:
+        benchmarkIntegrators()
+    elif sys.argv[1:] == ['check']:
+        checkContacts()
+    else:
+        main()
 
     
 